@@ -3,3 +3,4 @@ from .hdf5writer import HDF5Writer
 from .hdf5reader import HDF5Reader
 from .hdf5generator import HDF5Generator, HDF5Generator_Segment
 from .memorydataloader import MemoryDataLoader
+from .memorygenerator import MemoryGenerator
@@ -6,6 +6,17 @@ import numpy as np
 
 
 class HDF5Reader:
-    def load_hdf5(self, file_path, key):
+    def load_hdf5(self, file_path, key, dtype=None):
+        """Load an entire data set into memory. If dtype differs from the data set's data type the values are converted
+        by HDF5 while reading, straight into a single array of that type"""
         with h5py.File(file_path, "r") as f:
-            return np.array(f[key][()])
+            dataset = f[key]
+
+            # Reading the data set already returns a new array, do not copy it again
+            if dtype is None or np.dtype(dtype) == dataset.dtype:
+                return dataset[()]
+
+            data = np.empty(dataset.shape, dtype=dtype)
+            dataset.read_direct(data)
+
+            return data
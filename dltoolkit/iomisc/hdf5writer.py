@@ -15,7 +15,8 @@ BUF_SIZE = 10000
 
 class HDF5Writer:
     def __init__(self, dimensions, output_path, feat_key="X", label_key="Y", buf_size=BUF_SIZE, del_existing=False,
-                 dtype_feat=np.float32, dtype_label=np.uint8):
+                 dtype_feat=np.float32, dtype_label=np.uint8, chunks=None, compression=None, compression_opts=None,
+                 shuffle=False):
                  # dtype_feat=np.float16, dtype_label=np.uint8):
         """
         Create the new HDF5 file for simple 2D matrices
@@ -26,6 +27,12 @@ class HDF5Writer:
         :param buf_size: size of the in-memory buffer (= maximum number of records to keep in memory before
         :param del_existing: delete existing file with the same name True/False
         flushing to disc)
+        :param chunks: chunk shape of the features data set, e.g. (1, height, width, # of channels) to store each
+        image in its own chunk, None to let h5py decide (only used if the data set is compressed)
+        :param compression: compression filter of the features data set, e.g. "lzf" (fast) or "gzip", None for none
+        :param compression_opts: compression filter options, e.g. the gzip compression level
+        :param shuffle: True to apply the byte shuffle filter before compression, which groups the bytes of each
+        value and typically makes float data compress a lot better
         """
         self.include_labels = True          # Assume target labels are provided
 
@@ -40,7 +47,9 @@ class HDF5Writer:
 
         #  Create the two datasets: features and labels (optional)
         # print("---> setting HDF5 dtype to: {}".format(dtype_feat))
-        self.feat_dataset = self.db.create_dataset(feat_key, dimensions, dtype=dtype_feat)
+        self.feat_dataset = self.db.create_dataset(feat_key, dimensions, dtype=dtype_feat, chunks=chunks,
+                                                   compression=compression, compression_opts=compression_opts,
+                                                   shuffle=shuffle)
 
         if label_key is not None:
             self.label_dataset = self.db.create_dataset(label_key, (dimensions[0],), dtype=dtype_label)
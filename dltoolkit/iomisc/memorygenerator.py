@@ -0,0 +1,38 @@
+"""Batch generator for data sets that have already been loaded and preprocessed in memory. Used with Keras'
+fit_generator() the next batches are assembled on a background thread (up to max_queue_size batches ahead) while the
+model trains on the current batch.
+"""
+import numpy as np
+
+
+class MemoryGenerator:
+    def __init__(self, X, Y, batch_size, shuffle=True, seed=None):
+        self._X = X
+        self._Y = Y
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._seed = seed
+        self._num_images = X.shape[0]
+
+    def num_batches(self):
+        """Number of batches per epoch, i.e. the steps_per_epoch to use with fit_generator()"""
+        return int(np.ceil(self._num_images / self._batch_size))
+
+    def generator(self, num_epochs=np.inf):
+        """Generate batches of data, reshuffling the data set at the start of each epoch"""
+        epochs = 0
+        rnd = np.random.RandomState(self._seed)
+
+        while epochs < num_epochs:
+            if self._shuffle:
+                idxs = rnd.permutation(self._num_images)
+            else:
+                idxs = np.arange(self._num_images)
+
+            for i in np.arange(0, self._num_images, self._batch_size):
+                batch_idxs = idxs[i:i + self._batch_size]
+
+                # Return
+                yield (self._X[batch_idxs], self._Y[batch_idxs])
+
+            epochs += 1
@@ -3,12 +3,12 @@ from .base_conv_nn import BaseConvNN
 
 from keras.models import Sequential
 from keras.layers import BatchNormalization
-from keras.layers import Conv2D, MaxPooling2D, Dense, Flatten, Dropout
-from keras import backend as K
+from keras.layers import Conv2D, MaxPooling2D, Dense, Flatten, Dropout, Activation
 
 # Architecture parameters
 MINIVGGNET_DROPOUT_PERC1 = 0.25
 MINIVGGNET_DROPOUT_PERC2 = 0.5
+MINIVGGNET_DATA_FORMAT = "channels_last"
 
 
 class MiniVGGNN(BaseConvNN):
@@ -21,40 +21,52 @@ class MiniVGGNN(BaseConvNN):
         self._num_classes = num_classes
 
     def build_model(self):
-        # Set the input shape
+        # Always use channels_last (NHWC), cuDNN's fastest (Tensor Core) conv and BN kernels require it
         input_shape = (self._img_height, self._img_width, self._img_channels)
         channel_dim = -1
 
-        if K.image_data_format() == "channels_first":
-            input_shape = (self._img_channels, self._img_height, self._img_width)
-            channel_dim = 1
-
-        # Create the model
+        # Create the model, using Conv -> BN -> ReLU blocks so BN can be folded into the conv layers for inference
         self._model = Sequential()
 
-        self._model.add(Conv2D(32, (3, 3), padding="same", input_shape=input_shape, activation="relu"))
+        self._model.add(Conv2D(32, (3, 3), padding="same", data_format=MINIVGGNET_DATA_FORMAT, input_shape=input_shape))
         self._model.add(BatchNormalization(axis=channel_dim))
+        self._model.add(Activation("relu"))
 
-        self._model.add(Conv2D(32, (3, 3), padding="same", activation="relu"))
+        self._model.add(Conv2D(32, (3, 3), padding="same", data_format=MINIVGGNET_DATA_FORMAT))
         self._model.add(BatchNormalization(axis=channel_dim))
+        self._model.add(Activation("relu"))
 
-        self._model.add(MaxPooling2D(pool_size=(2,2)))
+        self._model.add(MaxPooling2D(pool_size=(2,2), data_format=MINIVGGNET_DATA_FORMAT))
         self._model.add(Dropout(MINIVGGNET_DROPOUT_PERC1))
 
-        self._model.add(Conv2D(64, (3, 3), padding="same", activation="relu"))
+        self._model.add(Conv2D(64, (3, 3), padding="same", data_format=MINIVGGNET_DATA_FORMAT))
         self._model.add(BatchNormalization(axis=channel_dim))
+        self._model.add(Activation("relu"))
 
-        self._model.add(Conv2D(64, (3, 3), padding="same", activation="relu"))
+        self._model.add(Conv2D(64, (3, 3), padding="same", data_format=MINIVGGNET_DATA_FORMAT))
         self._model.add(BatchNormalization(axis=channel_dim))
+        self._model.add(Activation("relu"))
 
-        self._model.add(MaxPooling2D(pool_size=(2,2)))
+        self._model.add(MaxPooling2D(pool_size=(2,2), data_format=MINIVGGNET_DATA_FORMAT))
         self._model.add(Dropout(MINIVGGNET_DROPOUT_PERC1))
 
         self._model.add(Flatten())
-        self._model.add(Dense(512, activation="relu"))
+        self._model.add(Dense(512))
         self._model.add(BatchNormalization())
+        self._model.add(Activation("relu"))
         self._model.add(Dropout(MINIVGGNET_DROPOUT_PERC2))
 
         self._model.add(Dense(self._num_classes, activation="softmax"))
 
         return self._model
+
+    def build_fused_inference_model(self, trained_model=None):
+        """Return a copy of the trained model with the BatchNormalization layers folded into the preceding layers,
+        for use at inference time only. Uses the model held by the class if no trained model is provided"""
+        # Import here, importing dltoolkit.utils at module level would load all of its dependencies to build a network
+        from dltoolkit.utils.fuse import fuse_bn_for_inference
+
+        if trained_model is None:
+            trained_model = self._model
+
+        return fuse_bn_for_inference(trained_model)
@@ -1,9 +1,11 @@
 """Various utility functions and constants"""
 from .constants import CIFAR10_CLASS_NAMES, ANIMALS_CLASS_NAMES, FLOWERS17_CLASS_NAMES
-from .generic import str2bool, ranked_accuracy, model_architecture_to_file, list_images, model_summary_to_file
+from .generic import str2bool, ranked_accuracy, model_architecture_to_file, list_images, model_summary_to_file,\
+    configure_session, data_parallel_model, throttled_pbar_update
 from .callback import TrainingMonitor
-from .visual import plot_training_history, model_performance, visualise_results
+from .visual import plot_training_history, model_performance, visualise_results, tile_images
 from .utils_rnn import *
 from .foundation import *
 from .image import rgb_to_gray, normalise, standardise_single, gray_to_rgb
-from .tfod import TFDataPoint
\ No newline at end of file
+from .tfod import TFDataPoint
+from .fuse import fuse_bn_for_inference, convert_to_int8_tflite
\ No newline at end of file
@@ -37,4 +37,4 @@ class TrainingMonitor(BaseLogger):
 
         # Create and save the accuracy/loss plot
         if len(self.hist["loss"]) > 1:
-            plot_training_history(self.hist, len(self.hist["loss"]), False, self.fig_path)
+            plot_training_history(self.hist, show=False, save_path=self.fig_path)
@@ -0,0 +1,110 @@
+"""Inference-time rewrites of trained Keras models"""
+from keras.models import Sequential
+from keras.layers import Conv2D, Dense, BatchNormalization
+from keras import activations
+import tensorflow as tf
+import numpy as np
+
+
+def _is_foldable(layer, bn):
+    """Return True if the BatchNormalization layer bn can be folded into the preceding layer"""
+    if not isinstance(layer, (Conv2D, Dense)) or not isinstance(bn, BatchNormalization):
+        return False
+
+    # A non-linearity between the layer and BN prevents folding
+    if layer.activation is not activations.linear:
+        return False
+
+    # BN has to normalise the output channels of the layer
+    ndim = len(layer.output_shape)
+    if isinstance(layer, Conv2D) and layer.data_format == "channels_first":
+        channel_axes = (1,)
+    else:
+        channel_axes = (-1, ndim - 1)
+
+    return bn.axis in channel_axes
+
+
+def _fold_bn(layer, bn):
+    """Fold the BN parameters into the weights and bias of the preceding Conv2D/Dense layer"""
+    weights = layer.get_weights()
+    W = weights[0]
+    b = weights[1] if layer.use_bias else np.zeros(W.shape[-1], dtype=W.dtype)
+
+    # BN only stores gamma (scale) and beta (center) when enabled
+    bn_weights = bn.get_weights()
+    gamma = bn_weights.pop(0) if bn.scale else np.ones_like(b)
+    beta = bn_weights.pop(0) if bn.center else np.zeros_like(b)
+    (mean, var) = bn_weights
+
+    # y = gamma * (Wx + b - mean) / sqrt(var + eps) + beta, the kernel's last axis holds the output channels
+    scale = gamma / np.sqrt(var + bn.epsilon)
+    W_hat = W * scale
+    b_hat = (b - mean) * scale + beta
+
+    return W_hat.astype(W.dtype), b_hat.astype(W.dtype)
+
+
+def fuse_bn_for_inference(model):
+    """
+    Create a copy of a trained Sequential model in which each BatchNormalization layer directly following a Conv2D or
+    Dense layer without an activation is folded into that layer's weights and bias. The copy makes the same
+    predictions as the original model, but no longer performs a separate BN pass over each layer's output. Layers
+    that cannot be folded (e.g. BN applied after a ReLU) are copied as is.
+    :param model: trained Keras Sequential model
+    :return: new (uncompiled) Sequential model for inference only
+    """
+    if not isinstance(model, Sequential):
+        raise ValueError("Only Sequential models can be fused", type(model))
+
+    fused = Sequential(name=model.name + "_fused")
+    layers = model.layers
+    i = 0
+
+    while i < len(layers):
+        layer = layers[i]
+        config = layer.get_config()
+
+        if i + 1 < len(layers) and _is_foldable(layer, layers[i + 1]):
+            weights = list(_fold_bn(layer, layers[i + 1]))
+            config["use_bias"] = True
+            i += 2
+        else:
+            weights = layer.get_weights()
+            i += 1
+
+        new_layer = layer.__class__.from_config(config)
+        fused.add(new_layer)
+        new_layer.set_weights(weights)
+
+    return fused
+
+
+def convert_to_int8_tflite(model_path, representative_data, output_path, num_samples=256):
+    """
+    Convert a saved Keras model to a TensorFlow Lite model using full integer (int8) post-training quantization. Fold
+    any BatchNormalization layers (see fuse_bn_for_inference) before saving the model, so BN is quantized as part of
+    the conv/dense layers rather than as separate ops. Requires TensorFlow 1.14 or later (tf.lite)
+    :param model_path: full path to the saved Keras model
+    :param representative_data: array of samples (e.g. training images) used to calibrate the quantization ranges
+    :param output_path: full path to the .tflite file
+    :param num_samples: number of samples to use for calibration
+    :return: N/A
+    """
+    if not hasattr(tf, "lite") or not hasattr(tf.lite, "RepresentativeDataset"):
+        raise ValueError("int8 TensorFlow Lite conversion requires TensorFlow 1.14 or later, found TensorFlow {}"
+                         .format(tf.__version__))
+
+    def representative_dataset():
+        for sample in representative_data[:num_samples]:
+            yield [sample[np.newaxis].astype(np.float32)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model_file(model_path)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
@@ -1,8 +1,15 @@
 """Generic utility functions"""
-from keras.utils import plot_model
+from keras.utils import plot_model, multi_gpu_model
+from keras import backend as K
+from tensorflow.core.protobuf import rewriter_config_pb2
+from tensorflow.python.client import device_lib
+import tensorflow as tf
 import argparse, os
 import numpy as np
 
+# Maximum number of progress bar updates per loop, each update writes to the console
+PBAR_MAX_UPDATES = 100
+
 
 def str2bool(v):
     """Attempt to convert a string to a boolean"""
@@ -14,6 +21,56 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+def configure_session(mixed_precision=False, xla=False):
+    """
+    Create the TensorFlow session used by Keras with the requested graph optimisations enabled. Call this before
+    building or loading a model.
+    :param mixed_precision: True to let TensorFlow rewrite the graph to run suitable ops (e.g. convolutions and
+    matrix multiplications) in float16, which uses the Tensor Cores on GPUs that have them. Numerically sensitive ops
+    like softmax, log and the loss reductions are kept in float32 by the rewrite. Requires TensorFlow 1.14 or later.
+    The rewrite does NOT add loss scaling (standalone Keras optimizers cannot be wrapped in a LossScaleOptimizer), so
+    small gradients may underflow in float16: experimental, off by default
+    :param xla: True to JIT compile clusters of ops with XLA, which fuses e.g. the BN, activation and other pointwise
+    ops of small, fixed input shape networks into single kernels
+    """
+    config = tf.ConfigProto()
+    rewrite_options = config.graph_options.rewrite_options
+    rewrite_fields = rewriter_config_pb2.RewriterConfig.DESCRIPTOR.fields_by_name
+
+    # Let TensorFlow convert the graph to the data layout preferred by the device (i.e. NHWC for Tensor Cores), older
+    # TensorFlow versions do not have this option and always run the layout optimizer
+    if "layout_optimizer" in rewrite_fields:
+        rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.ON
+
+    if mixed_precision:
+        if "auto_mixed_precision" not in rewrite_fields:
+            raise ValueError("mixed_precision requires TensorFlow 1.14 or later, found TensorFlow {}"
+                             .format(tf.__version__))
+
+        rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+
+    if xla:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+    K.set_session(tf.Session(config=config))
+
+
+def data_parallel_model(model):
+    """
+    Replicate a model across all available GPUs, each replica processing a slice of every batch
+    :param model: the Keras model to replicate, keep using this model to save weights and make predictions
+    :return: tuple of the model to compile and train and the number of replicas, scale the batch size and learning
+    rate by the number of replicas (linear scaling rule). The model is returned as is if fewer than two GPUs are
+    available
+    """
+    num_gpus = len([d for d in device_lib.list_local_devices() if d.device_type == "GPU"])
+
+    if num_gpus < 2:
+        return model, 1
+
+    return multi_gpu_model(model, gpus=num_gpus), num_gpus
+
+
 def ranked_accuracy(predictions, labels):
     """Return the rank 1 and rank 5 accuracy"""
     rank1 = 0
@@ -45,6 +102,23 @@ def model_summary_to_file(model, save_path):
         model.summary(print_fn=lambda x: fh.write(x + "\n"))
 
 
+def throttled_pbar_update(pbar, num_items):
+    """
+    Return a function that updates a progress bar with the index of the current item, but only for every
+    num_items / PBAR_MAX_UPDATES-th item so long loops do not slow down on console output (e.g. when it is logged)
+    :param pbar: the started progress bar
+    :param num_items: number of items in the loop
+    :return: function taking the index of the current item
+    """
+    update_every = max(1, num_items // PBAR_MAX_UPDATES)
+
+    def update(i):
+        if i % update_every == 0:
+            pbar.update(i)
+
+    return update
+
+
 def list_images(basePath, validExts=(".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff"), contains=None):
     """
     Return a generator containing the full paths to images with specific extensions. Original code by Adrian
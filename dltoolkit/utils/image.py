@@ -19,16 +19,25 @@ def mean_subtraction(img):
     return tmp_img/255.
 
 
-def standardise_single(image):
-    """Standardise a single images, values are float32 between 0.0 and 1.0"""
-    imgs_std = np.std(image)
-    imgs_mean = np.mean(image)
-    imgs_standardised = (image - imgs_mean) / imgs_std
+def standardise_single(image, out=None):
+    """Standardise a single images, values are float32 between 0.0 and 1.0. If out is provided the result is written
+    into it (e.g. a slice of a larger, preallocated array) instead of a new array and out is returned"""
+    # Scaling the standardised intensities to [0, 1] cancels out the mean and standard deviation, so scale the
+    # original intensities directly, computing the result in a single float32 pass without float64 temporaries
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
 
-    imgs_standardised = ((imgs_standardised - np.min(imgs_standardised)) / (np.max(imgs_standardised)-np.min(imgs_standardised)))
+    # Find the minimum and maximum in a single pass, OpenCV only supports single channel (2D) images
+    if image.ndim == 2:
+        (img_min, img_max, _, _) = cv2.minMaxLoc(image)
+    else:
+        img_min = np.min(image)
+        img_max = np.max(image)
 
-    # return imgs_standardised.astype(np.float16)
-    return imgs_standardised.astype(np.float32)
+    np.subtract(image, img_min, out=out, casting="unsafe")
+    out *= np.float32(1.0) / np.float32(img_max - img_min)
+
+    return out
 
 
 def standardise(imgs):
@@ -38,7 +47,7 @@ def standardise(imgs):
     imgs_standardised = (imgs-imgs_mean)/imgs_std
 
     for i in range(imgs.shape[0]):
-        imgs_standardised[i] = standardise_single(imgs_standardised[i])
+        standardise_single(imgs_standardised[i], out=imgs_standardised[i])
 
     # return imgs_standardised.astype(np.float16)
     return imgs_standardised.astype(np.float32)
@@ -2,6 +2,7 @@
 from keras.utils import plot_model
 from sklearn.metrics import classification_report
 import cv2
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import datetime
@@ -17,7 +18,7 @@ from sklearn.metrics import f1_score, precision_score, recall_score, classificat
 def plot_training_history(hist, show=True, save_path=None, time_stamp=False, metric="acc"):
     """
     Plot Keras training results to a figure and display and/or save it
-    :param hist: a Keras History object
+    :param hist: a Keras History object, or its history dictionary (e.g. as kept by TrainingMonitor)
     :param show: True to show the figure, False if not
     :param save_path: full path to save the figure to, None if no saving required
     :param time_stamp: whether to add a date/time stamp to the file name
@@ -25,8 +26,10 @@ def plot_training_history(hist, show=True, save_path=None, time_stamp=False, met
     import seaborn as sns
     import datetime
 
+    history = hist.history if hasattr(hist, "history") else hist
+
     # Don't include validation results if there aren't any (assumes only one loss/metric pair is used)
-    includes_val = len(hist.history) > 2
+    includes_val = len(history) > 2
 
     # Set the style
     sns.set_style("whitegrid")
@@ -38,34 +41,42 @@ def plot_training_history(hist, show=True, save_path=None, time_stamp=False, met
     elif metric.startswith("dice_coef"):
         ylabel = "Dice coefficient"
 
+    # Stack the training (and validation) results so each axis is plotted with a single call
+    if includes_val:
+        metrics = np.column_stack((history[metric], history["val_"+metric]))
+        losses = np.column_stack((history["loss"], history["val_loss"]))
+        metric_labels = ["Training "+ylabel, "Validation "+ylabel]
+        loss_labels = ["Training loss", "Validation loss"]
+    else:
+        metrics = np.asarray(history[metric])
+        losses = np.asarray(history["loss"])
+        metric_labels = ["Training "+ylabel]
+        loss_labels = ["Training loss"]
+
+    epochs = np.arange(len(losses))
+
     # Create a dual axis graph
     fig, ax1 = plt.subplots(figsize=(16, 10))
     ax2 = ax1.twinx()
 
     # Plot the metric
-    p1 = ax1.plot(hist.history[metric], '-', linewidth=3.0, label="Training "+ylabel)
-    if includes_val:
-        p2 = ax1.plot(hist.history["val_"+metric], '-', linewidth=3.0, label="Validation "+ylabel)
+    p_metric = ax1.plot(epochs, metrics, '-', linewidth=3.0)
     ax1.set_xlabel('Epoch')
     ax1.set_ylabel(ylabel)
 
     # Plot the loss
-    p3 = ax2.plot(hist.history['loss'], '--', linewidth=3.0, label="Training loss")
-    if includes_val:
-        p4 = ax2.plot(hist.history['val_loss'], '--', linewidth=3.0, label="Validation loss")
+    p_loss = ax2.plot(epochs, losses, '--', linewidth=3.0)
     ax2.set_ylabel('Loss')
 
     # Combine into one legend
-    if includes_val:
-        p = p1+p2+p3+p4
-        min_ix = np.argmin(hist.history["val_loss"])
-        min_val = hist.history["val_loss"][min_ix]
-        min_text = "Lowest validation loss"
-    else:
-        p = p1+p3
-        min_ix = np.argmin(hist.history["loss"])
-        min_val = hist.history["loss"][min_ix]
-        min_text = "Lowest loss"
+    p = p_metric + p_loss
+    for (line, label) in zip(p, metric_labels + loss_labels):
+        line.set_label(label)
+
+    min_losses = losses[:, -1] if includes_val else losses
+    min_ix = np.argmin(min_losses)
+    min_val = min_losses[min_ix]
+    min_text = "Lowest validation loss" if includes_val else "Lowest loss"
 
     labs = [l.get_label() for l in p]
     ax1.legend(p, labs, loc="center right")
@@ -83,12 +94,12 @@ def plot_training_history(hist, show=True, save_path=None, time_stamp=False, met
     ax2.grid(None)
 
     # Set ticks
-    major_ticks = np.arange(0, len(hist.history[metric]), 1)
-    ax1.set_xticks(major_ticks)
+    ax1.set_xticks(epochs)
 
-    plt.title("Training loss/" + ylabel + " by epoch")
+    ax1.set_title("Training loss/" + ylabel + " by epoch")
 
-    if show:
+    # Showing the figure blocks until it is closed, skip it on headless (non-interactive backend) hosts
+    if show and matplotlib.get_backend().lower() != "agg":
         plt.show()
 
     if save_path is not None:
@@ -101,27 +112,51 @@ def plot_training_history(hist, show=True, save_path=None, time_stamp=False, met
         save_path = save_path + ".png"
         fig.savefig(save_path)
 
-    plt.close()
+    plt.close(fig)
 
 
 def model_performance(nn, test_set, test_labels, class_names, batch_size):
-    """Make predictions on a test set and print the classification report, return the predictions"""
+    """Make predictions on a test set and print the classification report, return the predictions. Predicting does
+    not require memory for gradients, so the batch size can typically be a lot larger than the one used for training"""
     pred = nn.model.predict(x=test_set, batch_size=batch_size)
-    print(classification_report(test_labels.argmax(axis=-1), pred.argmax(axis=1), target_names=class_names))
+
+    # Convert the one-hot encoded labels and predicted probabilities to class indices, once each
+    y_true = test_labels.argmax(axis=1)
+    y_pred = pred.argmax(axis=1)
+    print(classification_report(y_true, y_pred, target_names=class_names))
 
     return pred
 
 
-def visualise_results(test_set, test_labels, pred_labels, class_names):
-    # Visualise a few random  images, increase their size for better visualisation
-    idxs = np.random.randint(0, len(test_set), size=(10,))
-    for (i, image) in enumerate(test_set[idxs]):
-        print("Image {} is a {} predicted to be a {}".format(i + 1,
-                                                             class_names[test_labels[idxs[i]].argmax(axis=0)],
-                                                             class_names[pred_labels[idxs[i]].argmax(axis=0)]))
-        image = cv2.resize(image, (150, 150), interpolation=cv2.INTER_LINEAR)
-        cv2.imshow("Image", image)
-        cv2.waitKey(0)
+def tile_images(imgs, num_per_row):
+    """Combine an array of equally sized images with shape (-1, height, width, channels) into a single grid image
+    with num_per_row columns. Images that do not fill up a complete row are ignored"""
+    (num_imgs, img_height, img_width, img_channels) = imgs.shape
+    num_rows = num_imgs // num_per_row
+
+    # Move the row/column grid dimensions next to the image height/width dimensions and merge them
+    grid = imgs[:num_rows * num_per_row].reshape(num_rows, num_per_row, img_height, img_width, img_channels)
+    grid = grid.transpose(0, 2, 1, 3, 4)
+
+    return grid.reshape(num_rows * img_height, num_per_row * img_width, img_channels)
+
+
+def visualise_results(test_set, test_labels, pred_labels, class_names, num_images=10, num_per_row=5, img_dim=150):
+    """Display a few random images in a single grid, increasing their size for better visualisation, and print the
+    ground truth and predicted class of each one"""
+    idxs = np.random.randint(0, len(test_set), size=(num_images,))
+    true_idxs = test_labels[idxs].argmax(axis=1)
+    pred_idxs = pred_labels[idxs].argmax(axis=1)
+
+    for (i, (true_idx, pred_idx)) in enumerate(zip(true_idxs, pred_idxs)):
+        print("Image {} is a {} predicted to be a {}".format(i + 1, class_names[true_idx], class_names[pred_idx]))
+
+    # Resize the grid as a whole rather than each individual image
+    grid = tile_images(test_set[idxs], num_per_row)
+    grid = cv2.resize(grid, (num_per_row * img_dim, (num_images // num_per_row) * img_dim),
+                      interpolation=cv2.INTER_LINEAR)
+    cv2.imshow("Images", grid)
+    cv2.waitKey(0)
 
 
 def plot_roc_curve(ground_truth_imgs, predicted_scores_pos, show=True, save_path=None, time_stamp=False):
@@ -13,7 +13,7 @@ from dltoolkit.preprocess import ResizeWithAspectRatioPreprocessor, ImgToArrayPr
 from dltoolkit.iomisc import HDF5Generator, HDF5Writer
 from dltoolkit.nn.cnn import AlexNetNN
 from dltoolkit.utils import TrainingMonitor, ranked_accuracy, model_architecture_to_file
-from dltoolkit.utils.generic import list_images
+from dltoolkit.utils.generic import list_images, throttled_pbar_update
 
 from keras.preprocessing.image import ImageDataGenerator
 from keras.optimizers import Adam
@@ -70,6 +70,7 @@ def create_hdf5():
         # Prepare progress bar
         widgets = ["Creating HDF5 database ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
         pbar = progressbar.ProgressBar(maxval=len(paths), widgets=widgets).start()
+        update_pbar = throttled_pbar_update(pbar, len(paths))
 
         # Preprocess each image and write to hfd5. Keep track of mean RGB values for the training set
         for (i, (path, label)) in enumerate(zip(paths, labels)):
@@ -83,7 +84,7 @@ def create_hdf5():
                 B_vals.append(b)
 
             writer.add([image], [label])
-            pbar.update(i)
+            update_pbar(i)
 
         pbar.finish()
         writer.close()
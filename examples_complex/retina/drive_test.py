@@ -79,15 +79,10 @@ def convert_pred_to_img(pred, patch_dim, threshold=0.5, verbose=False):
     """Convert patch *predictions* to patch *images* (the opposite of convert_img_to_pred)"""
     start_time = time.time()
 
-    pred_images = np.empty((pred.shape[0], pred.shape[1]))
-    # pred = np.reshape(pred, newshape=(pred.shape[0], pred.shape[1] * pred.shape[2]))
-
-    for i in range(pred.shape[0]):
-        for pix in range(pred.shape[1]):
-            if pred[i, pix, 1] > threshold:        # TODO for multiple classes > 2 use argmax
-                pred_images[i, pix] = 1
-            else:
-                pred_images[i, pix] = 0
+    # Threshold the blood vessel probability of all pixels at once, then look up the pixel value of each class
+    # (background, blood vessel) in a single gather. TODO for multiple classes > 2 use argmax
+    class_values = np.array([0., 1.])
+    pred_images = np.take(class_values, (pred[:, :, 1] > threshold).view(np.uint8))
 
     pred_images = np.reshape(pred_images, (pred.shape[0], patch_dim, patch_dim, 1))
 
@@ -142,7 +137,7 @@ def apply_masks(preds, masks):
 
 def load_masks(mask_path, key, patch_dim):
     """Load masks and crop and extend them like the images and ground truths were"""
-    masks = HDF5Reader().load_hdf5(mask_path, key).astype("uint8")
+    masks = HDF5Reader().load_hdf5(mask_path, key, dtype=np.uint8)
 
     masks = crop_image(masks, masks.shape[1], masks.shape[2])
     masks, _, _ = extend_images(masks, patch_dim)
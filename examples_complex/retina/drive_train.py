@@ -28,7 +28,8 @@ from settings import settings_drive as settings
 from drive_utils import perform_image_preprocessing, perform_groundtruth_preprocessing
 
 from dltoolkit.iomisc import HDF5Writer
-from dltoolkit.utils.generic import list_images, model_architecture_to_file, model_summary_to_file
+from dltoolkit.utils.generic import list_images, model_architecture_to_file, model_summary_to_file,\
+    throttled_pbar_update
 from dltoolkit.nn.segment import UNet_NN
 from dltoolkit.utils.visual import plot_training_history
 from dltoolkit.utils.foundation import dice_coef_loss, dice_coef
@@ -64,6 +65,8 @@ def convert_to_hdf5(img_path, img_shape, img_exts, key, ext):
     # Loop through all images
     widgets = ["Creating HDF5 database ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
     pbar = progressbar.ProgressBar(maxval=len(imgs_list), widgets=widgets).start()
+    update_pbar = throttled_pbar_update(pbar, len(imgs_list))
+
     for i, img in enumerate(imgs_list):
         if img_exts == ".gif":
             # Ground truth and masks are single colour channel .gif files
@@ -76,7 +79,7 @@ def convert_to_hdf5(img_path, img_shape, img_exts, key, ext):
             image = cv2.imread(img)
 
         hdf5_writer.add([image], None)
-        pbar.update(i)
+        update_pbar(i)
 
     pbar.finish()
     hdf5_writer.close()
@@ -182,19 +185,16 @@ def convert_img_to_pred(ground_truths, num_model_channels, verbose=False):
     img_width = ground_truths.shape[2]
 
     ground_truths = np.reshape(ground_truths, (ground_truths.shape[0], img_height * img_width))
-    new_masks = np.empty((ground_truths.shape[0], img_height * img_width, num_model_channels))
 
-    for image in range(ground_truths.shape[0]):
-        if verbose and image % 1000 == 0:
-            print("{}/{}".format(image, ground_truths.shape[0]))
+    # The DRIVE ground truths only hold two classes, there is no encoding of additional classes to convert
+    if num_model_channels != 2:
+        raise ValueError("Only two classes (background and blood vessels) are supported", num_model_channels)
 
-        for pix in range(img_height*img_width):
-            if ground_truths[image, pix] == 0.:      # TODO: update for num_model_channels > 2
-                new_masks[image, pix, 0] = 1.0
-                new_masks[image, pix, 1] = 0.0
-            else:
-                new_masks[image, pix, 0] = 0.0
-                new_masks[image, pix, 1] = 1.0
+    # One-hot encode all pixels at once: background (0.) is class 0, any other value is class 1
+    new_masks = np.empty((ground_truths.shape[0], img_height * img_width, num_model_channels), dtype=np.uint8)
+    background = (ground_truths == 0.).astype(np.uint8)
+    new_masks[..., 0] = background
+    new_masks[..., 1] = 1 - background
 
     if verbose:
         print("Elapsed time: {}".format(time.time() - start_time))
@@ -285,6 +285,6 @@ if __name__ == "__main__":
     print("\n--- Training complete")
 
     # Plot the training results - currently breaks if training stopped early
-    plot_training_history(hist, settings.NUM_EPOCH, show=False, save_path=settings.OUTPUT_PATH + unet.title + "_DRIVE", time_stamp=True)
+    plot_training_history(hist, show=False, save_path=settings.OUTPUT_PATH + unet.title + "_DRIVE", time_stamp=True)
 
     # TODO: calculate performance metrics
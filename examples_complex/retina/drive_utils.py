@@ -1,6 +1,7 @@
 """Common functions for drive_train.py and drive_test.py"""
 from dltoolkit.iomisc import HDF5Reader
 from dltoolkit.utils.image import rgb_to_gray, normalise, clahe_equalization, adjust_gamma
+from dltoolkit.utils.visual import tile_images
 
 import numpy as np
 from PIL import Image
@@ -16,7 +17,7 @@ def crop_image(imgs, img_height, img_width):
 
 def perform_image_preprocessing(image_path, key, is_training=True):
     """Perform image pre-processing, resulting pixel values are between 0 and 1"""
-    imgs = HDF5Reader().load_hdf5(image_path, key).astype("uint8")
+    imgs = HDF5Reader().load_hdf5(image_path, key, dtype=np.uint8)
 
     # Convert RGB to gray scale
     imgs = rgb_to_gray(imgs)
@@ -39,7 +40,7 @@ def perform_image_preprocessing(image_path, key, is_training=True):
 
 def perform_groundtruth_preprocessing(ground_truth_path, key, is_training=True):
     """Perform ground truth image pre-processing, resulting pixel values are between 0 and 1"""
-    imgs = HDF5Reader().load_hdf5(ground_truth_path, key).astype("uint8")
+    imgs = HDF5Reader().load_hdf5(ground_truth_path, key, dtype=np.uint8)
 
     # Cut off top and bottom pixel rows to convert images to squares
     if is_training:
@@ -66,21 +67,5 @@ def group_images(imgs, num_per_row):
     """Attempts to put an array of images into a single image, provided the number of image can be divided by
     the number of images desired per row
     """
-    all_rows = []
-
-    for i in range(int(imgs.shape[0] / num_per_row)):
-        # Add the first image to the current row
-        row = imgs[i * num_per_row]
-
-        # Concatenate the remaining images to the current row
-        for k in range(i * num_per_row + 1, i * num_per_row + num_per_row):
-            row = np.concatenate((row, imgs[k]), axis=1)
-
-        all_rows.append(row)
-
-    # Take the first row and concatenate the remaining ones
-    final_image = all_rows[0]
-    for i in range(1, len(all_rows)):
-        final_image = np.concatenate((final_image,all_rows[i]),axis=0)
-
-    return final_image
+    # Images that do not fill up a complete row are ignored, the grid is built in a single copy
+    return tile_images(imgs, num_per_row)
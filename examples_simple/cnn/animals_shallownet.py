@@ -1,17 +1,22 @@
-"""Animal classification using ShallowNet"""
-from dltoolkit.preprocess import ResizePreprocessor, ImgToArrayPreprocessor, NormalisePreprocessor
-from dltoolkit.iomisc import MemoryDataLoader
+"""Animal classification using ShallowNet
+To load a saved model use:
+    --load=true
+"""
+from dltoolkit.preprocess import ResizePreprocessor, ImgToArrayPreprocessor
+from dltoolkit.iomisc import MemoryDataLoader, MemoryGenerator
 from dltoolkit.nn.cnn import ShallowNetNN
-from dltoolkit.utils import plot_training_history, ANIMALS_CLASS_NAMES
+from dltoolkit.utils import plot_training_history, configure_session, data_parallel_model, str2bool,\
+    fuse_bn_for_inference, convert_to_int8_tflite, tile_images
 
 from keras.optimizers import SGD
+from keras.models import load_model
 
 from sklearn.preprocessing import LabelBinarizer
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report
 
 from imutils import paths
-import argparse
+import argparse, pickle
 import numpy as np
 import cv2
 
@@ -19,72 +24,126 @@ import cv2
 LEARNING_RATE = 0.005
 NUM_EPOCH = 20
 BATCH_SIZE = 32
+PREDICT_BATCH_SIZE = 1024
+PREFETCH_BATCHES = 10
 RANDOM_STATE = 122177
+VAL_PROP = 0.1
 NUM_CLASSES = 3
+MODEL_PATH = "../../savedmodels/"
 OUTPUT_PATH = "../../output/"
 DATASET_NAME = "animals"
+DISPLAY_DIM = 256
+LBL_BIN_PATH = MODEL_PATH + DATASET_NAME + "_lbl_bin.pickle"
 
 # Check script arguments
 ap = argparse.ArgumentParser(description="Apply ShallowNet to animal images.")
 ap.add_argument("-d", "--dataset", required=True, help="path to the data set")
+ap.add_argument("-l", "--load", type=str2bool, nargs='?',
+                const=True, required=False, help="Set to True to load a previously trained model")
+ap.add_argument("-t", "--tflite", type=str2bool, nargs='?', const=True, required=False,
+                help="Set to True to also export the trained model to int8 TensorFlow Lite (TensorFlow 1.14+)")
 args = vars(ap.parse_args())
 
+# Fuse ops with XLA
+configure_session(xla=True)
+
 # Extract the full path to each image in the data set's location
-imagePaths = list(paths.list_images(args["dataset"]))
+imagePaths = np.array(list(paths.list_images(args["dataset"])))
 
-# Load the images, normalising and resizing each to 32x32 pixels upon loading
+# Load the images, resizing each to 32x32 pixels and converting it to the dimension ordering set in keras.json upon
+# loading, then normalise all of them at once using float32
 resize_pre = ResizePreprocessor(32, 32)
 itoarr_pre = ImgToArrayPreprocessor()
-norm_pre = NormalisePreprocessor()
 
-dl = MemoryDataLoader(preprocessors=[resize_pre, itoarr_pre, norm_pre])
+dl = MemoryDataLoader(preprocessors=[resize_pre, itoarr_pre])
 (X, Y) = dl.load(imagePaths, verbose=500)
+X = X.astype(np.float32, copy=False)
+X *= np.float32(1.0 / 255.0)
+
+# Fit the label binarizer once on all labels so the training and test set use the same encoding, a saved model is
+# used with the label binarizer saved alongside it
+if args["load"]:
+    with open(LBL_BIN_PATH, "rb") as f:
+        lbl_bin = pickle.load(f)
+else:
+    lbl_bin = LabelBinarizer().fit(Y)
+
+# Split into a training and test set and one-hot encode the labels, keep the test image paths for visualisation
+(X_train, X_test, Y_train, Y_test, _, paths_test) = train_test_split(X, Y, imagePaths, test_size=0.25,
+                                                                     random_state=RANDOM_STATE)
+Y_train = lbl_bin.transform(Y_train)
+Y_test = lbl_bin.transform(Y_test)
 
-# Split into a training and test set
-(X_train, X_test, Y_train, Y_test) = train_test_split(X, Y, test_size=0.25, random_state=RANDOM_STATE)
-
-# One-hot encode the labels
-Y_train = LabelBinarizer().fit_transform(Y_train)
-Y_test= LabelBinarizer().transform(Y_test)
-
-# Initialise the NN and optimiser
-opt = SGD(lr=LEARNING_RATE)
 nnarch = ShallowNetNN(num_classes=NUM_CLASSES)
-nnarch.build_model()
-nnarch.model.compile(loss="categorical_crossentropy", optimizer=opt, metrics=["accuracy"])
-
 MODEL_NAME = DATASET_NAME + "_" + nnarch.title
 
-# Train the network
-hist = nnarch.model.fit(X_train, Y_train, batch_size=BATCH_SIZE, epochs=NUM_EPOCH, validation_data=(X_test, Y_test), verbose=1)
+# Fit the model or load the saved one
+if args["load"]:
+    print("Loading the previously trained {} model".format(nnarch.title))
+    nnarch.model = load_model(MODEL_PATH + MODEL_NAME + "_fused.model")
+else:
+    print("Training the {} model".format(nnarch.title))
+
+    # Hold out a small validation set, the test set is only used to evaluate the final model
+    (X_train, X_val, Y_train, Y_val) = train_test_split(X_train, Y_train, test_size=VAL_PROP,
+                                                        random_state=RANDOM_STATE)
+
+    # Initialise the NN and optimiser, train on all available GPUs scaling the batch size and learning rate linearly
+    nnarch.build_model()
+    (train_model, num_replicas) = data_parallel_model(nnarch.model)
+    opt = SGD(lr=LEARNING_RATE * num_replicas)
+    train_model.compile(loss="categorical_crossentropy", optimizer=opt, metrics=["accuracy"])
+
+    # Train the network, the images were preprocessed once upon loading, the next training batches are prepared on a
+    # background thread while the current one is being trained on
+    train_gen = MemoryGenerator(X_train, Y_train, BATCH_SIZE * num_replicas, seed=RANDOM_STATE)
+    hist = train_model.fit_generator(train_gen.generator(),
+                                     steps_per_epoch=train_gen.num_batches(),
+                                     validation_data=(X_val, Y_val),
+                                     epochs=NUM_EPOCH,
+                                     max_queue_size=PREFETCH_BATCHES,
+                                     verbose=1)
+
+    # Plot the training results
+    plot_training_history(hist, show=False, save_path=OUTPUT_PATH + MODEL_NAME, time_stamp=True)
+
+    # Only inference is performed from here on, fold any BatchNormalization layers into the layers preceding them
+    # and save the resulting model (which has fewer layers than the trained one)
+    nnarch.model = fuse_bn_for_inference(nnarch.model)
+    nnarch.model.save(MODEL_PATH + MODEL_NAME + "_fused.model")
+
+    with open(LBL_BIN_PATH, "wb") as f:
+        pickle.dump(lbl_bin, f)
+
+    # Optionally convert the fused model to an int8 TensorFlow Lite model for deployment
+    if args["tflite"]:
+        convert_to_int8_tflite(MODEL_PATH + MODEL_NAME + "_fused.model", X_train,
+                               MODEL_PATH + MODEL_NAME + "_int8.tflite")
 
 # Make predictions on the test set and print the results to the console
-preds = nnarch.model.predict(X_test, batch_size=BATCH_SIZE)
-print(classification_report(Y_test.argmax(axis=-1), preds.argmax(axis=1), target_names=ANIMALS_CLASS_NAMES))
-
-# Plot the training results
-plot_training_history(hist, NUM_EPOCH, show=False, save_path=OUTPUT_PATH + MODEL_NAME, time_stamp=True)
-
-# Visualise a few random images (could be training and/or test images)
-imagePaths = np.array(list(paths.list_images(args["dataset"])))
-idxs = np.random.randint(0, len(imagePaths), size=(10,))
-
-# Load and preprocess as before
-(X, Y) = dl.load(imagePaths=imagePaths[idxs])
-
-# Make predictions
-preds = nnarch.model.predict(X)
-
-# Display results
-for (i, imagePath) in enumerate(imagePaths[idxs]):
-    image = cv2.imread(imagePath)
-    print("Image {} is a {} predicted to be a {} with probability {}%".format(i + 1, Y[i], ANIMALS_CLASS_NAMES[preds[i].argmax(axis=0)], preds[i].max(axis=0)))
-
-    if ANIMALS_CLASS_NAMES[preds[i].argmax(axis=0)] == Y[i]:
-        colour = (0, 255, 0)
-    else:
-        colour = (0, 0, 255)
-
-    cv2.putText(image, "Prediction: {} ({}%)".format(ANIMALS_CLASS_NAMES[preds[i].argmax(axis=0)], preds[i].max(axis=0)), (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color=colour, thickness=2)
-    cv2.imshow("Image", image)
-    cv2.waitKey(0)
+preds = nnarch.model.predict(X_test, batch_size=PREDICT_BATCH_SIZE)
+print(classification_report(Y_test.argmax(axis=-1), preds.argmax(axis=1), target_names=lbl_bin.classes_))
+
+# Visualise a few random test images, reusing the predictions made on the already preprocessed test set rather than
+# loading, preprocessing and predicting the images again. Determine the predicted class, its probability and whether
+# it is correct once for all images
+idxs = np.random.randint(0, len(X_test), size=(10,))
+labels = lbl_bin.classes_[Y_test[idxs].argmax(axis=1)]
+pred_names = lbl_bin.classes_[preds[idxs].argmax(axis=1)]
+pred_max = preds[idxs].max(axis=1)
+correct = pred_names == labels
+
+for (i, (label, pred_name, prob)) in enumerate(zip(labels, pred_names, pred_max)):
+    print("Image {} is a {} predicted to be a {} with probability {}%".format(i + 1, label, pred_name, prob))
+
+# Display the results in a single grid, reading each original image once and resizing the images to the same
+# dimensions so they can be tiled
+images = np.array([cv2.resize(cv2.imread(imagePath), (DISPLAY_DIM, DISPLAY_DIM)) for imagePath in paths_test[idxs]])
+
+for (image, pred_name, prob, is_correct) in zip(images, pred_names, pred_max, correct):
+    colour = (0, 255, 0) if is_correct else (0, 0, 255)
+    cv2.putText(image, "Prediction: {} ({}%)".format(pred_name, prob), (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7,
+                color=colour, thickness=2)
+
+cv2.imshow("Images", tile_images(images, num_per_row=5))
+cv2.waitKey(0)
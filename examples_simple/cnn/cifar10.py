@@ -10,7 +10,7 @@ To load a saved model use:
 from dltoolkit.nn.cnn import MiniVGGNN, ShallowNetNN
 from dltoolkit.preprocess import NormalisePreprocessor
 from dltoolkit.utils import plot_training_history, str2bool, model_architecture_to_file, CIFAR10_CLASS_NAMES,\
-    visualise_results, model_performance
+    visualise_results, model_performance, configure_session
 
 from keras.optimizers import SGD
 from keras.datasets import cifar10
@@ -24,6 +24,7 @@ import argparse
 LEARNING_RATE = 0.01
 NUM_EPOCH = 50
 BATCH_SIZE = 64
+PREDICT_BATCH_SIZE = 1024
 MOMENTUM = 0.9
 LR_DECAY = 0.01 / NUM_EPOCH
 
@@ -44,6 +45,8 @@ ap.add_argument("-n", "--net", type=str, nargs='?', default="",
                 const=True, required=True, help="Set to the name of the neural net to use")
 args = vars(ap.parse_args())
 
+configure_session()
+
 # Load data
 ((X_train, Y_train), (X_test, Y_test)) = cifar10.load_data()
 
@@ -95,10 +98,14 @@ else:
     # note: the test data set should NOT be used for validation_data, but rather a true validation set should be used
 
     # Plot the training results
-    plot_training_history(hist, NUM_EPOCH, show=False, save_path=OUTPUT_PATH + MODEL_NAME, time_stamp=True)
+    plot_training_history(hist, show=False, save_path=OUTPUT_PATH + MODEL_NAME, time_stamp=True)
+
+# Fold the BatchNormalization layers into the preceding layers, only inference is performed from here on
+if isinstance(nnarch, MiniVGGNN):
+    nnarch.model = nnarch.build_fused_inference_model()
 
 # Make predictions on the test set and print the results to the console
-Y_pred = model_performance(nnarch, X_test, Y_test, CIFAR10_CLASS_NAMES, BATCH_SIZE)
+Y_pred = model_performance(nnarch, X_test, Y_test, CIFAR10_CLASS_NAMES, PREDICT_BATCH_SIZE)
 
 # Visualise a few random test images, increase the size for better visualisation
 visualise_results(X_test, Y_test, Y_pred, CIFAR10_CLASS_NAMES)
@@ -48,4 +48,4 @@ Y_pred = model.predict(X_test, batch_size=BATCH_SIZE)
 print(classification_report(Y_test.argmax(axis=1), Y_pred.argmax(axis=1), target_names=CIFAR10_CLASS_NAMES))
 
 # Plot loss and accuracy
-plot_training_history(hist, NUM_EPOCH)
+plot_training_history(hist)
@@ -13,7 +13,7 @@ from dltoolkit.nn.cnn import MiniVGGNN, VGG16CustomNN
 from dltoolkit.preprocess import NormalisePreprocessor, ResizeWithAspectRatioPreprocessor, ImgToArrayPreprocessor
 from dltoolkit.iomisc import MemoryDataLoader
 from dltoolkit.utils import plot_training_history, str2bool, model_architecture_to_file, FLOWERS17_CLASS_NAMES,\
-    model_performance, visualise_results
+    model_performance, visualise_results, configure_session
 
 from keras.optimizers import SGD, RMSprop
 from keras.models import load_model
@@ -59,6 +59,8 @@ ap.add_argument("-n", "--net", type=str, nargs='?', default="",
                 const=True, required=True, help="Set to the name of the neural net to use")
 args = vars(ap.parse_args())
 
+configure_session()
+
 # Instantiate the selected network
 if args["net"] == "MiniVGGNN":
     nnarch = MiniVGGNN(MINIVGG_IMG_WIDTH, MINIVGG_IMG_HEIGHT, IMG_CHANNELS, NUM_CLASSES)
@@ -145,7 +147,11 @@ else:
     # note: the test data set should NOT be used for validation_data, but rather a true validation set should be used
 
     # Save the training and validation results
-    plot_training_history(hist, NUM_EPOCH_TRAIN, show=False, save_path=OUTPUT_PATH + MODEL_NAME, time_stamp=True)
+    plot_training_history(hist, show=False, save_path=OUTPUT_PATH + MODEL_NAME, time_stamp=True)
+
+# Fold the BatchNormalization layers into the preceding layers, only inference is performed from here on
+if isinstance(nnarch, MiniVGGNN):
+    nnarch.model = nnarch.build_fused_inference_model()
 
 # Make predictions on the test set and print the results to the console
 print("Post training performance:")
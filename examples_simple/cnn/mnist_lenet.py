@@ -3,8 +3,9 @@ To load a saved model use:
     --load=true
 """
 from dltoolkit.nn.cnn import LeNetNN
-from dltoolkit.preprocess import NormalisePreprocessor
-from dltoolkit.utils import str2bool, plot_training_history
+from dltoolkit.iomisc import MemoryGenerator
+from dltoolkit.utils import str2bool, plot_training_history, configure_session, visualise_results,\
+    data_parallel_model, fuse_bn_for_inference, convert_to_int8_tflite
 
 from keras.models import load_model
 from keras.optimizers import SGD
@@ -15,45 +16,70 @@ from sklearn.metrics import classification_report
 from sklearn import datasets
 
 import numpy as np
-import argparse
-import cv2
+import argparse, os
 
 # Constants
 LEARNING_RATE = 0.01
 RANDOM_STATE = 122177
+VAL_PROP = 0.1
 TEST_PROP = 0.25
 NUM_EPOCH = 5
 BATCH_SIZE = 128
+PREDICT_BATCH_SIZE = 1024
+PREFETCH_BATCHES = 10
 NUM_CLASSES = 10
 
 MODEL_PATH = "../savedmodels/"
 OUTPUT_PATH = "../output/"
 DATASET_NAME = "mnist"
 
+
+def load_mnist(cache_path, nnarch):
+    """Load and normalise MNIST, then split it and one-hot encode its labels. The normalised data set is cached to disk,
+    subsequent runs load the cache instead of downloading and preprocessing the data set again. The split is not cached
+    so changes to TEST_PROP and RANDOM_STATE take effect"""
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            (X, Y) = (cache["X"], cache["Y"])
+    else:
+        # Load dataset, assume channels_last, normalise in place using float32 (i.e. without a float64 intermediate)
+        (X, Y) = datasets.fetch_openml("mnist_784", version=1, as_frame=False, return_X_y=True)
+        X = X.astype(np.float32)
+        X /= np.float32(255.0)
+        Y = Y.astype("int")
+
+        # Reshape from (# of records, 784) to (# of records, img width, img height, # of channels)
+        X = X.reshape(X.shape[0], nnarch._img_width, nnarch._img_height, nnarch._img_channels)
+
+        np.savez(cache_path, X=X, Y=Y)
+
+    # Split the data set and one-hot encode the labels
+    (X_train, X_test, Y_train, Y_test) = train_test_split(X, Y, test_size=TEST_PROP, random_state=RANDOM_STATE)
+    Y_train = to_categorical(Y_train, nnarch._num_classes)
+    Y_test = to_categorical(Y_test, nnarch._num_classes)
+
+    return X_train, X_test, Y_train, Y_test
+
+
 # Parse arguments
 ap = argparse.ArgumentParser()
 ap.add_argument("-l", "--load", type=str2bool, nargs='?',
                 const=True, required=False, help="Set to True to load a previously trained model")
+ap.add_argument("-t", "--tflite", type=str2bool, nargs='?', const=True, required=False,
+                help="Set to True to also export the trained model to int8 TensorFlow Lite (TensorFlow 1.14+)")
 args = vars(ap.parse_args())
 
+# Fuse ops with XLA
+configure_session(xla=True)
+
 # Instantiate the network
 nnarch = LeNetNN(NUM_CLASSES)
 
 # String used for naming various things
 MODEL_NAME = DATASET_NAME + "_" + nnarch.title
 
-# Load dataset, assume channels_last, normalise
-dataset = datasets.fetch_mldata("MNIST Original")
-X = NormalisePreprocessor().preprocess(dataset.data)
-Y = dataset.target
-
-# Reshape from (# of records, 784) to (# of records, img width, img height, # of channels)
-X = X.reshape(X.shape[0], nnarch._img_width, nnarch._img_height, nnarch._img_channels)
-
-# Split the data set and one-hot encode the labels
-(X_train, X_test, Y_train, Y_test) = train_test_split(X, Y.astype("int"), test_size=TEST_PROP, random_state=RANDOM_STATE)
-Y_train = to_categorical(Y_train, nnarch._num_classes)
-Y_test = to_categorical(Y_test, nnarch._num_classes)
+# Load the (cached) data set
+(X_train, X_test, Y_train, Y_test) = load_mnist(MODEL_PATH + DATASET_NAME + "_normalised.npz", nnarch)
 
 # Fit the model or load the saved one
 if args["load"]:
@@ -62,32 +88,44 @@ if args["load"]:
 else:
     print("Training the {} model".format(nnarch.title))
 
-    # Setup and train the model
-    sgd = SGD(lr=LEARNING_RATE)
+    # Hold out a small validation set, the test set is only used to evaluate the final model
+    (X_train, X_val, Y_train, Y_val) = train_test_split(X_train, Y_train, test_size=VAL_PROP,
+                                                        random_state=RANDOM_STATE)
+
+    # Setup the model, train on all available GPUs scaling the batch size and learning rate linearly
     nnarch.build_model()
-    nnarch.model.compile(loss="categorical_crossentropy", optimizer=sgd, metrics=["accuracy"])
-    hist = nnarch.model.fit(X_train, Y_train, validation_data=(X_test, Y_test),
-                     batch_size=BATCH_SIZE,
-                     epochs=NUM_EPOCH,
-                     verbose=1)
-    # note: the test data set should NOT be used for validation_data, but rather a true validation set should be used
+    (train_model, num_replicas) = data_parallel_model(nnarch.model)
+    sgd = SGD(lr=LEARNING_RATE * num_replicas)
+    train_model.compile(loss="categorical_crossentropy", optimizer=sgd, metrics=["accuracy"])
+
+    # Prepare the next training batches on a background thread while the current one is being trained on
+    train_gen = MemoryGenerator(X_train, Y_train, BATCH_SIZE * num_replicas, seed=RANDOM_STATE)
+    hist = train_model.fit_generator(train_gen.generator(),
+                                     steps_per_epoch=train_gen.num_batches(),
+                                     validation_data=(X_val, Y_val),
+                                     epochs=NUM_EPOCH,
+                                     max_queue_size=PREFETCH_BATCHES,
+                                     verbose=1)
 
     # Save the trained model (architecture, weights, loss/optimizer, state)
     nnarch.model.save(MODEL_PATH + MODEL_NAME + ".model")
 
+    # Fold any BatchNormalization layers and optionally convert the result to an int8 TensorFlow Lite model for
+    # deployment
+    fused_path = MODEL_PATH + MODEL_NAME + "_fused.model"
+    fuse_bn_for_inference(nnarch.model).save(fused_path)
+
+    if args["tflite"]:
+        convert_to_int8_tflite(fused_path, X_train, MODEL_PATH + MODEL_NAME + "_int8.tflite")
+
     # Plot results
-    plot_training_history(hist, NUM_EPOCH, show=False, save_path=OUTPUT_PATH + MODEL_NAME, time_stamp=True)
+    plot_training_history(hist, show=False, save_path=OUTPUT_PATH + MODEL_NAME, time_stamp=True)
 
 # Predict on the test set and print the results
-Y_pred = nnarch.model.predict(X_test, batch_size=BATCH_SIZE)
+Y_pred = nnarch.model.predict(X_test, batch_size=PREDICT_BATCH_SIZE)
 print(classification_report(Y_test.argmax(axis=1),
                             Y_pred.argmax(axis=1),
                             target_names=[str(x) for x in range(NUM_CLASSES)]))
 
 # Visualise a few random test images, increase the size for better visualisation
-idxs = np.random.randint(0, len(X_test), size=(10,))
-for (i, image) in enumerate(X_test[idxs]):
-    print("Image {} is a {} predicted to be a {}".format(i+1, Y_test[idxs[i]].argmax( axis=0), Y_pred[idxs[i]].argmax(axis=0)))
-    image = cv2.resize(image, (96, 96), interpolation=cv2.INTER_LINEAR)
-    cv2.imshow("Image", image)
-    cv2.waitKey(0)
+visualise_results(X_test, Y_test, Y_pred, [str(x) for x in range(NUM_CLASSES)], img_dim=96)
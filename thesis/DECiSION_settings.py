@@ -9,6 +9,8 @@ FLDR_GROUND_TRUTH = "groundtruths"                      # folder with the ground
 FLDR_IMAGES = "images"                                  # folder with the images
 HDF5_EXT = ".h5"
 HDF5_KEY = "image"
+HDF5_CHUNK_SHAPE_2D = None                              # U-Net HDF5 chunk shape (4D), None for ~1 MB chunks
+HDF5_CHUNK_SHAPE_3D = None                              # 3D U-Net HDF5 chunk shape (5D), None for ~1 MB chunks
 IMG_EXTENSION = ".jpg"
 
 # Image dimensions
@@ -1,14 +1,183 @@
 """Image handling and conversion methods for U-Net and 3D U-net models"""
 from dltoolkit.iomisc import HDF5Reader, HDF5Writer
 from dltoolkit.utils.image import standardise_single
-from dltoolkit.utils.generic import list_images
+from dltoolkit.utils.generic import list_images, throttled_pbar_update
+from dltoolkit.utils.visual import tile_images
 from sklearn.model_selection import train_test_split
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import cv2
-import time, os, progressbar, argparse
+import time, os, progressbar, argparse, threading, heapq
 import matplotlib.pyplot as plt
 
+# Number of images to stage in memory before writing them to an HDF5 data set in a single write
+HDF5_WRITE_BATCH = 64
+
+# Maximum amount of memory (in MB) used to buffer patient volumes before writing them to an HDF5 data set
+HDF5_WRITE_BUFFER_MB = int(os.environ.get("HDF5_WRITE_BUFFER_MB", 2048))
+
+# Target size of a single HDF5 chunk in bytes, unless settings.HDF5_CHUNK_SHAPE_2D/_3D specify a chunk shape
+HDF5_CHUNK_BYTES = 1024 * 1024
+
+# HDF5 compression of the images (byte shuffled floats, fast lzf) and ground truths (mostly zeros, gzip)
+HDF5_COMPRESSION_IMAGES = {"compression": "lzf", "shuffle": True}
+HDF5_COMPRESSION_MASKS = {"compression": "gzip", "compression_opts": 1}
+
+# Data types of the images (standardised to [0, 1], float16 keeps ~3 significant digits) and ground truths in HDF5
+HDF5_DTYPE_IMAGES = np.float16
+HDF5_DTYPE_MASKS = np.uint8
+
+# Number of worker threads used to load and pre-process images, defaults to the number of CPU cores
+NUM_WORKERS = int(os.environ.get("THESIS_NUM_WORKERS", os.cpu_count()))
+
+# Worker threads used to load and pre-process images, shared by all calls so each thread's CLAHE objects are reused
+_executor = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+
+# Per worker thread state, CLAHE objects cannot be shared between threads
+_thread_data = threading.local()
+
+
+def _hdf5_chunks(dimensions, dtype, settings):
+    """Return the HDF5 chunk shape for a data set of images with shape (-1, [slices,] height, width, channels). Unless
+    settings.HDF5_CHUNK_SHAPE_2D (U-Net) or settings.HDF5_CHUNK_SHAPE_3D (3D U-Net) is set, each chunk holds as many
+    whole slices (of a single patient) as fit in HDF5_CHUNK_BYTES, but at least one
+    """
+    (setting, chunk_shape) = (("HDF5_CHUNK_SHAPE_3D", settings.HDF5_CHUNK_SHAPE_3D) if len(dimensions) == 5
+                              else ("HDF5_CHUNK_SHAPE_2D", settings.HDF5_CHUNK_SHAPE_2D))
+
+    if chunk_shape is not None:
+        if len(chunk_shape) != len(dimensions):
+            raise ValueError("{} must have {} dimensions to match the data set shape {}, got {}"
+                             .format(setting, len(dimensions), dimensions, chunk_shape))
+
+        return tuple(chunk_shape)
+
+    img_shape = dimensions[-3:]
+    slice_bytes = int(np.prod(img_shape)) * np.dtype(dtype).itemsize
+    num_slices = int(np.clip(HDF5_CHUNK_BYTES // slice_bytes, 1, dimensions[-4]))
+
+    # 3D: one patient, multiple slices per chunk - 2D: multiple images per chunk
+    return (1,) * (len(dimensions) - 4) + (num_slices,) + img_shape
+
+
+def _hdf5_buf_size(buf_size, chunk_len, total):
+    """Round the number of images/patients buffered before each HDF5 write down to a multiple of the chunk's leading
+    dimension (but at least one chunk), so every write except the last one covers whole chunks and no chunk has to be
+    read back, decompressed and compressed again by the next write
+    """
+    buf_size = max(chunk_len, buf_size - buf_size % chunk_len)
+    return min(buf_size, total)
+
+
+# Image pre-processing functions
+def _get_clahe(clip_limit, tile_grid_size):
+    """Return the current thread's CLAHE histogram equalization object for the given parameters, creating it on first
+    use only"""
+    if not hasattr(_thread_data, "clahe"):
+        _thread_data.clahe = {}
+
+    key = (clip_limit, tile_grid_size)
+    if key not in _thread_data.clahe:
+        _thread_data.clahe[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+
+    return _thread_data.clahe[key]
+
+
+def _get_scratch(shape):
+    """Return the current thread's uint8 scratch buffer for a single cropped image, creating it on first use (or when
+    the image size changes) only"""
+    scratch = getattr(_thread_data, "scratch", None)
+
+    if scratch is None or scratch.shape != shape:
+        scratch = _thread_data.scratch = np.empty(shape, dtype=np.uint8)
+
+    return scratch
+
+
+def _load_gray(img_path):
+    """Load an image as grayscale by reading the encoded file into memory and decoding the buffer, which skips
+    OpenCV's path handling in cv2.imread. JPEG slices are decoded by libjpeg-turbo (SIMD) in the opencv-python wheels,
+    check cv2.getBuildInformation() when OpenCV is built from source"""
+    return cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+def _preprocess_image(img_path, settings, is_mask, out=None):
+    """Load a single image or ground truth, crop it to the region of interest and apply image pre-processing. OpenCV
+    releases the GIL while loading and processing the image, so this can be run on multiple threads at once
+    :param img_path: full path to the image
+    :param settings: settings object
+    :param is_mask: True for ground truths, False for image
+    :param out: optional array with shape (height, width) to write the pre-processed image into
+    :return: pre-processed image with shape (height, width)
+    """
+    image = _load_gray(img_path)
+
+    # Copy the region of interest into the current thread's contiguous scratch buffer, which is reused for every image
+    crop = _get_scratch((image.shape[0] - 2 * settings.IMG_CROP_HEIGHT, image.shape[1] - 2 * settings.IMG_CROP_WIDTH))
+    np.copyto(crop, image[settings.IMG_CROP_HEIGHT:image.shape[0] - settings.IMG_CROP_HEIGHT,
+                          settings.IMG_CROP_WIDTH:image.shape[1] - settings.IMG_CROP_WIDTH])
+
+    # Apply pre-processing in place
+    if is_mask:
+        # Apply binary thresholding to ground truth masks
+        cv2.threshold(crop, settings.MASK_BINARY_THRESHOLD, settings.MASK_BLOODVESSEL, cv2.THRESH_BINARY, dst=crop)
+
+        # The scratch buffer is overwritten by the next image, so return a copy if there is no output array
+        if out is None:
+            return crop.copy()
+
+        out[...] = crop
+        return out
+    else:
+        # Apply CLAHE histogram equalization
+        _get_clahe(2, (16, 16)).apply(crop, crop)
+
+        # Standardise
+        return standardise_single(crop, out=out)
+
+
+def _list_patient_slices(patients_list, img_exts, settings):
+    """Return the sorted paths to the slices SLICE_START up to SLICE_END for each patient subfolder. The subfolders are
+    scanned on all worker threads at once, once per call instead of once per patient in the pre-processing loop. Do
+    not call this function from a worker thread
+    :param patients_list: list of paths to patient volumes
+    :param img_exts: image extensions to search for
+    :param settings: settings object
+    :return: list with a list of slice paths for each patient
+    """
+    def list_slices(p_folder):
+        # Only the first SLICE_END paths (in sorted order) are needed, select them without sorting the entire folder
+        imgs_list = heapq.nsmallest(settings.SLICE_END, list_images(basePath=p_folder, validExts=img_exts))
+        return imgs_list[settings.SLICE_START:]
+
+    return list(_executor.map(list_slices, patients_list))
+
+
+def _preprocess_patient(imgs_list, img_shape, settings, is_mask, out=None, dtype=np.float32):
+    """Load and pre-process the slices of a single patient volume, the slices are processed on all worker threads at
+    once. Do not call this function from a worker thread
+    :param imgs_list: list of paths to the patient's slices, see _list_patient_slices
+    :param img_shape: shape of an image/ground truth
+    :param settings: settings object
+    :param is_mask: True for ground truths, False for image
+    :param out: optional array with shape (slices, height, width, channels) to write the slices into
+    :param dtype: data type of the array that is allocated if out is not provided
+    :return: Numpy array with shape (slices, height, width, channels)
+    """
+    num_slices = settings.SLICE_END - settings.SLICE_START
+
+    if out is None:
+        out = np.zeros((num_slices, img_shape[0], img_shape[1], img_shape[2]), dtype=dtype)
+
+    # Read the slices in the current patient's folder, writing each straight into the (single) channel of its slot
+    list(_executor.map(lambda slice_ix: _preprocess_image(imgs_list[slice_ix], settings, is_mask,
+                                                          out=out[slice_ix, :, :, 0]),
+                       range(len(imgs_list))))
+
+    return out
+
 
 # 3D U-Net functions
 def load_training_3d(settings):
@@ -31,25 +200,35 @@ def load_training_3d(settings):
                                                                       random_state=settings.RANDOM_STATE,
                                                                       shuffle=True)
 
-    print("Loading training images")
-    train_imgs = load_images_3d(train_img_l, (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS),
-                                img_exts=settings.IMG_EXTENSION, settings=settings)
+    img_shape = (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS)
+    load_val = settings.TRN_TRAIN_VAL_SPLIT > 0.0
 
-    print("Loading training ground truths")
-    train_grndtr = load_images_3d(train_msk_l, (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS),
-                                  img_exts=settings.IMG_EXTENSION, settings=settings, is_mask=True)
-    train_grndtr_ext_conv = convert_img_to_pred_3d(train_grndtr, settings.NUM_CLASSES, settings.VERBOSE)
+    # The data sets are independent, load them at the same time so one data set's slices are decoded and
+    # pre-processed while another is waiting for the disk. Each loader still processes its slices on the shared worker
+    # threads, so the loaders are run on threads of their own
+    with ThreadPoolExecutor(max_workers=4) as load_executor:
+        print("Loading training images and ground truths")
+        train_imgs = load_executor.submit(load_images_3d, train_img_l, img_shape, settings.IMG_EXTENSION, settings)
+        train_grndtr = load_executor.submit(load_images_3d, train_msk_l, img_shape, settings.IMG_EXTENSION, settings,
+                                            is_mask=True)
 
-    num_patients = train_imgs.shape[0]
+        if load_val:
+            print("Loading validation images and ground truths")
+            val_imgs = load_executor.submit(load_images_3d, val_img_l, img_shape, settings.IMG_EXTENSION, settings)
+            val_grndtr = load_executor.submit(load_images_3d, val_msk_l, img_shape, settings.IMG_EXTENSION, settings,
+                                              is_mask=True)
+
+        train_imgs = train_imgs.result()
+        train_grndtr = train_grndtr.result()
 
-    if settings.TRN_TRAIN_VAL_SPLIT > 0.0:
-        print("Loading validation images")
-        val_imgs = load_images_3d(val_img_l, (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS),
-                                  img_exts=settings.IMG_EXTENSION, settings=settings)
+        if load_val:
+            val_imgs = val_imgs.result()
+            val_grndtr = val_grndtr.result()
+
+    train_grndtr_ext_conv = convert_img_to_pred_3d(train_grndtr, settings.NUM_CLASSES, settings.VERBOSE)
+    num_patients = train_imgs.shape[0]
 
-        print("Loading validation ground truths")
-        val_grndtr = load_images_3d(val_msk_l, (settings.IMG_HEIGHT, settings.IMG_WIDTH, settings.IMG_CHANNELS),
-                                    img_exts=settings.IMG_EXTENSION, settings=settings, is_mask=True)
+    if load_val:
         val_grndtr_ext_conv = convert_img_to_pred_3d(val_grndtr, settings.NUM_CLASSES, settings.VERBOSE)
 
         return train_imgs, train_grndtr, train_grndtr_ext_conv, val_imgs, val_grndtr, val_grndtr_ext_conv, num_patients
@@ -74,49 +253,24 @@ def load_images_3d(patients_list, img_shape, img_exts, settings, is_mask=False):
         return None
 
     num_slices = settings.SLICE_END - settings.SLICE_START
-    clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(16, 16))
 
     # Loop through all images
     widgets = ["Reading images ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
     pbar = progressbar.ProgressBar(maxval=len(patients_list), widgets=widgets).start()
+    update_pbar = throttled_pbar_update(pbar, len(patients_list))
 
-    data = np.zeros((len(patients_list), num_slices, img_shape[0], img_shape[1], img_shape[2]), dtype=np.float32)
-
-    # Loop through each patient subfolder
-    for patient_ix, p_folder in enumerate(patients_list):
-        imgs_list = sorted(list(list_images(basePath=p_folder, validExts=img_exts)))[settings.SLICE_START:settings.SLICE_END]
-
-        # Read each slice in the current patient's folder
-        for slice_ix, slice_img in enumerate(imgs_list):
-            image = cv2.imread(slice_img, cv2.IMREAD_GRAYSCALE)
-
-            # Crop to the region of interest
-            image = image[settings.IMG_CROP_HEIGHT:image.shape[0] - settings.IMG_CROP_HEIGHT,
-                    settings.IMG_CROP_WIDTH:image.shape[1] - settings.IMG_CROP_WIDTH]
-
-            # Apply any preprocessing
-            if is_mask:
-                # Apply binary thresholding to ground truth masks
-                _, image = cv2.threshold(image, settings.MASK_BINARY_THRESHOLD, settings.MASK_BLOODVESSEL,
-                                         cv2.THRESH_BINARY)
-            else:
-                # Apply CLAHE histogram equalization
-                image = clahe.apply(image)
-
-                # Standardise
-                image = standardise_single(image)
+    # Allocate the data directly in the order required by the 3D U-net: (-1, height, width, slices, intensity)
+    data = np.zeros((len(patients_list), img_shape[0], img_shape[1], num_slices, img_shape[2]), dtype=np.float32)
+    slices_lists = _list_patient_slices(patients_list, img_exts, settings)
 
-            # Reshape from (height, width) to (height, width, 1)
-            image = image.reshape((img_shape[0], img_shape[1], img_shape[2]))
-            data[patient_ix, slice_ix] = image
-
-        pbar.update(patient_ix)
+    # Load and pre-process the slices of each patient on all worker threads, directly into the patient's volume using
+    # a (slices, height, width, intensity) view
+    for patient_ix, imgs_list in enumerate(slices_lists):
+        _preprocess_patient(imgs_list, img_shape, settings, is_mask, out=np.moveaxis(data[patient_ix], 2, 0))
+        update_pbar(patient_ix)
 
     pbar.finish()
 
-    # Tranpose dimensions into the order required by the 3D U-net: (-1, height, width, slices, intensity)
-    data = np.transpose(data, axes=(0, 2, 3, 1, 4))
-
     return data
 
 
@@ -152,56 +306,44 @@ def create_hdf5_db_3d(patients_list, dn_name, img_path, img_shape, img_exts, key
     print("reading patient folders: ", patients_list)
     print("---")
 
-    # Prepare the HDF5 writer
+    # Prepare the HDF5 writer, buffering as many patient volumes as fit into the memory budget, aligned to whole chunks
+    dtype = HDF5_DTYPE_MASKS if is_mask else HDF5_DTYPE_IMAGES
+    chunks = _hdf5_chunks((len(patients_list), num_slices) + img_shape, dtype, settings)
+    patient_bytes = num_slices * int(np.prod(img_shape)) * np.dtype(dtype).itemsize
+    buf_size = _hdf5_buf_size(HDF5_WRITE_BUFFER_MB * 1024 * 1024 // patient_bytes, chunks[0], len(patients_list))
     hdf5_writer = HDF5Writer((len(patients_list), num_slices) + img_shape,
                              output_path,
                              feat_key=key,
                              label_key=None,
                              del_existing=True,
-                             buf_size=len(patients_list),
-                             # dtype_feat=np.float16 if not is_mask else np.uint8)
-                             dtype_feat = np.float32 if not is_mask else np.uint8)
-
-    # Prepare for CLAHE histogram equalization
-    clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(16, 16))
+                             buf_size=buf_size,
+                             dtype_feat=dtype,
+                             chunks=chunks,
+                             **(HDF5_COMPRESSION_MASKS if is_mask else HDF5_COMPRESSION_IMAGES))
 
     # Loop through all images
     widgets = ["Creating HDF5 database ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
     pbar = progressbar.ProgressBar(maxval=len(patients_list), widgets=widgets).start()
+    update_pbar = throttled_pbar_update(pbar, len(patients_list))
 
-    # Loop through each patient subfolder
-    for patient_ix, p_folder in enumerate(patients_list):
-        imgs_list = sorted(list(list_images(basePath=p_folder, validExts=img_exts)))[settings.SLICE_START:settings.SLICE_END]
-        # imgs = np.zeros((num_slices, img_shape[0], img_shape[1], img_shape[2]), dtype=np.float16)
-        imgs = np.zeros((num_slices, img_shape[0], img_shape[1], img_shape[2]), dtype=np.float32)
+    # Load and pre-process the slices of each patient on all worker threads, while the previous patient is being
+    # written (compressed and flushed to disk) on a separate thread
+    with ThreadPoolExecutor(max_workers=1) as write_executor:
+        pending_write = None
 
-        # Read each slice in the current patient's folder
-        for slice_ix, slice_img in enumerate(imgs_list):
-            image = cv2.imread(slice_img, cv2.IMREAD_GRAYSCALE)
+        for patient_ix, imgs_list in enumerate(_list_patient_slices(patients_list, img_exts, settings)):
+            # The slices are standardised straight into the data type stored on disk
+            imgs = _preprocess_patient(imgs_list, img_shape, settings, is_mask, dtype=dtype)
 
-            # Crop to the region of interest
-            image = image[settings.IMG_CROP_HEIGHT:image.shape[0] - settings.IMG_CROP_HEIGHT,
-                    settings.IMG_CROP_WIDTH:image.shape[1] - settings.IMG_CROP_WIDTH]
+            # Wait for the previous write to finish (raising any error it produced), then write all slices for the
+            # current patient
+            if pending_write is not None:
+                pending_write.result()
 
-            # Apply any preprocessing
-            if is_mask:
-                # Apply binary thresholding to ground truth masks
-                _, image = cv2.threshold(image, settings.MASK_BINARY_THRESHOLD, settings.MASK_BLOODVESSEL,
-                                         cv2.THRESH_BINARY)
-            else:
-                # Apply CLAHE histogram equalization
-                image = clahe.apply(image)
+            pending_write = write_executor.submit(hdf5_writer.add, [imgs], None)
+            update_pbar(patient_ix)
 
-                # Standardise
-                image = standardise_single(image)
-
-            # Reshape from (height, width) to (height, width, 1)
-            image = image.reshape((img_shape[0], img_shape[1], img_shape[2]))
-            imgs[slice_ix] = image
-
-        # Write all slices for the current patient
-        hdf5_writer.add([imgs], None)
-        pbar.update(patient_ix)
+        pending_write.result()
 
     pbar.finish()
     hdf5_writer.close()
@@ -209,18 +351,35 @@ def create_hdf5_db_3d(patients_list, dn_name, img_path, img_shape, img_exts, key
     return output_path
 
 
-def convert_img_to_pred_3d(ground_truths, num_classes, verbose=False):
+def _one_hot_encode(ground_truths, num_classes, out=None):
+    """One-hot encode ground truth pixel intensities 0 (first class), 255 (second class) etc. into a uint8 array with
+    an additional dimension of size num_classes. Each class is written directly as uint8, without scaling the
+    intensities to class labels first. If out is provided the encoding is written into it instead of a new array
+    """
+    if out is None:
+        out = np.empty(ground_truths.shape + (num_classes,), dtype=np.uint8)
+
+    if num_classes == 2:
+        # Intensities above 127 are blood vessels, everything else is background
+        np.greater(ground_truths, 127, out=out[..., 1])
+        np.subtract(1, out[..., 1], out=out[..., 0])
+    else:
+        for c in range(num_classes):
+            np.equal(ground_truths, c * 255, out=out[..., c])
+
+    return out
+
+
+def convert_img_to_pred_3d(ground_truths, num_classes, verbose=False, out=None):
     """Convert an array of grayscale images with shape (-1, height, width, slices, 1) to an array of the same length
     # with shape (-1, height, width, slices, num_classes). That is the shape the 3D Unet produces. Does not generalise
     # to more than two classes, and requires the ground truth image to only contain 0 (first class) or 255 (second
-    class)
+    class). Optionally write the result into a preallocated uint8 array out
     """
     start_time = time.time()
 
-    # Convert 0 to 0 and 255 to 1, then perform one-hot encoding and squeeze the single-dimension
-    tmp_truths = ground_truths/255
-    new_masks = (np.arange(num_classes) == tmp_truths[..., None]).astype(np.uint8)
-    new_masks = np.squeeze(new_masks, axis=4)
+    # Perform one-hot encoding, squeezing the single-dimension
+    new_masks = _one_hot_encode(ground_truths[:, :, :, :, 0], num_classes, out=out)
 
     if verbose:
         print("Elapsed time: {:.2f}s".format(time.time() - start_time))
@@ -236,21 +395,12 @@ def convert_pred_to_img_3d(pred, threshold=0.5, verbose=False):
     """
     start_time = time.time()
 
-    # Set pixels with intensities greater than the threshold to the blood vessel class,
-    # all other pixels to the background class
-    idx = pred[:, :, :, :, 1] > threshold
-    local_pred = pred.copy()
-    local_pred[idx, 1] = 1
-    local_pred[idx, 0] = 0
-    local_pred[~idx, 1] = 0
-    local_pred[~idx, 0] = 1
-    pred_images = (np.argmax(local_pred, axis=-1)*255).astype(np.uint8)
+    # Set pixels with intensities greater than the threshold to the blood vessel class (255),
+    # all other pixels to the background class (0)
+    pred_images = np.multiply(pred[:, :, :, :, 1] > threshold, 255, dtype=np.uint8)
 
-    # Add a dimension for the color channel
-    pred_images = np.reshape(pred_images, tuple(pred_images.shape[0:4]) + (1,))
-
-    # Permute the dimensions
-    pred_images = np.transpose(pred_images, axes=(0, 3, 1, 2, 4))
+    # Move the slices dimension to the front and add a dimension for the color channel (both are views, not copies)
+    pred_images = np.moveaxis(pred_images, 3, 1)[..., np.newaxis]
 
     if verbose:
         print("Elapsed time: {:.2f}s".format(time.time() - start_time))
@@ -282,47 +432,51 @@ def create_hdf5_db(imgs_list, dn_name, img_path, img_shape, key, ext, settings,
     output_path = os.path.join(os.path.dirname(img_path), tmp_name) + ext
     print(output_path)
 
-    # Prepare the HDF5 writer
+    # Prepare the HDF5 writer, it flushes each batch of images (aligned to whole chunks) to disk as soon as it is added
+    dtype = HDF5_DTYPE_MASKS if is_mask else HDF5_DTYPE_IMAGES
+    chunks = _hdf5_chunks((len(imgs_list),) + img_shape, dtype, settings)
+    batch_size = _hdf5_buf_size(HDF5_WRITE_BATCH, chunks[0], len(imgs_list))
     hdf5_writer = HDF5Writer(((len(imgs_list),) + img_shape),
                              output_path=output_path,
                              feat_key=key,
                              label_key=None,
                              del_existing=True,
-                             buf_size=len(imgs_list),
-                             # dtype_feat=np.float16 if not is_mask else np.uint8
-                             dtype_feat=np.float32 if not is_mask else np.uint8
+                             buf_size=batch_size,
+                             dtype_feat=dtype,
+                             chunks=chunks,
+                             **(HDF5_COMPRESSION_MASKS if is_mask else HDF5_COMPRESSION_IMAGES)
                              )
 
-    # Prepare for CLAHE histogram equalization
-    clahe = cv2.createCLAHE(clipLimit=2, tileGridSize=(16, 16))
+    # Stage the preprocessed images in a preallocated buffer
+    buf = np.empty((batch_size,) + img_shape, dtype=dtype)
 
     # Loop through all images
     widgets = ["Creating HDF5 database ", progressbar.Percentage(), " ", progressbar.Bar(), " ", progressbar.ETA()]
     pbar = progressbar.ProgressBar(maxval=len(imgs_list), widgets=widgets).start()
-    for i, img in enumerate(imgs_list):
-        image = cv2.imread(img, cv2.IMREAD_GRAYSCALE)
+    update_pbar = throttled_pbar_update(pbar, len(imgs_list))
+
+    # Load and pre-process the images on all CPU cores one batch at a time, the results are returned in order. The
+    # next batch is submitted before the current one is written, so at most two batches are held in memory
+    def preprocess_batch(start):
+        return _executor.map(lambda img: _preprocess_image(img, settings, is_mask),
+                             imgs_list[start:start + batch_size])
 
-        # Crop to the region of interest
-        image = image[settings.IMG_CROP_HEIGHT:image.shape[0] - settings.IMG_CROP_HEIGHT,
-                settings.IMG_CROP_WIDTH:image.shape[1] - settings.IMG_CROP_WIDTH]
+    next_images = preprocess_batch(0)
 
-        # Apply pre-processing
-        if is_mask:
-            # Apply binary thresholding to ground truth masks
-            _, image = cv2.threshold(image, settings.MASK_BINARY_THRESHOLD, settings.MASK_BLOODVESSEL,
-                                     cv2.THRESH_BINARY)
-        else:
-            # Apply CLAHE histogram equalization
-            image = clahe.apply(image)
+    for start in range(0, len(imgs_list), batch_size):
+        images = next_images
+        if start + batch_size < len(imgs_list):
+            next_images = preprocess_batch(start + batch_size)
 
-            # Standardise
-            image = standardise_single(image)
+        for j, image in enumerate(images):
+            # Copy into the (single) channel of the buffer slot, no need to reshape to (height, width, 1) first
+            buf[j, :, :, 0] = image
 
-        # Reshape from (height, width) to (height, width, 1)
-        image = image.reshape((img_shape[0], img_shape[1], img_shape[2]))
+            update_pbar(start + j)
 
-        hdf5_writer.add([image], None)
-        pbar.update(i)
+        # Write the batch, the last batch may be smaller than the buffer. The writer keeps references to the rows it
+        # has not flushed yet, so hand it a copy as buf is overwritten by the next batch
+        hdf5_writer.add(buf[:j + 1].copy(), None)
 
     pbar.finish()
     hdf5_writer.close()
@@ -330,22 +484,22 @@ def create_hdf5_db(imgs_list, dn_name, img_path, img_shape, key, ext, settings,
     return output_path
 
 
-def convert_img_to_pred(ground_truths, num_classes, verbose=False):
+def convert_img_to_pred(ground_truths, num_classes, verbose=False, out=None):
     """Convert an array of grayscale images with shape (-1, height, width, 1) to an array of the same length with
     shape (-1, height, width, num_classes). That is the shape produced by the U-net model.
     :param ground_truths: array of grayscale images, pixel values are integers 0 (background) or 255 (blood vessels)
     :param num_classes: the number of classes used
     :param verbose: True if additional information is to be printed to the console during training
+    :param out: optional preallocated uint8 array with shape (-1, height, width, num_classes) to write the result into
     :return: one-hot encoded version of the image
     """
     start_time = time.time()
 
-    # Convert 0 to 0 and 255 to 1, then perform one-hot encoding and squeeze the single-dimension
-    tmp_truths = ground_truths/255
-    new_masks = (np.arange(num_classes) == tmp_truths[..., None]).astype(np.uint8)
-
+    # Perform one-hot encoding and squeeze the single-dimension
     if ground_truths.shape[-1] == 1:
-        new_masks = np.squeeze(new_masks, axis=3)
+        ground_truths = ground_truths[:, :, :, 0]
+
+    new_masks = _one_hot_encode(ground_truths, num_classes, out=out)
 
     if verbose:
         print("Elapsed time: {:.2f}s".format(time.time() - start_time))
@@ -361,26 +515,14 @@ def convert_pred_to_img(pred, threshold=0.5, num_channels=1, verbose=False):
     blood vessel classes."""
     start_time = time.time()
 
-    # Set pixels with a blood class probability greater than the threshold to the blood vessel class,
-    # all other pixels to the background class
-    if num_channels == 3:
-        idx = pred[:, :, :, :, 1] > threshold
-    else:
-        idx = pred[:, :, :, 1] > threshold
-    local_pred = pred.copy()
-    local_pred[idx, 1] = 1
-    local_pred[idx, 0] = 0
-    local_pred[~idx, 1] = 0
-    local_pred[~idx, 0] = 1
-
-    # Determine the class label for each pixel for all images
-    pred_images = (np.argmax(local_pred, axis=-1) * 255).astype(np.uint8)
-
-    # Add a dimension for the color channel(s)
-    if num_channels == 3:
-        pred_images = np.reshape(pred_images, tuple(pred_images.shape[0:-1]) + (num_channels,))
-    else:
-        pred_images = np.reshape(pred_images, tuple(pred_images.shape) + (num_channels,))
+    # Set pixels with a blood class probability greater than the threshold to the blood vessel class (255),
+    # all other pixels to the background class (0)
+    pred_images = np.multiply(pred[..., 1] > threshold, 255, dtype=np.uint8)
+
+    # Add a dimension for the color channel, 3 channel predictions already hold the color channels in their last
+    # dimension
+    if num_channels != 3:
+        pred_images = pred_images[..., np.newaxis]
 
     if verbose:
         print("Elapsed time: {:.2f}s".format(time.time() - start_time))
@@ -404,7 +546,7 @@ def read_images(image_path, key, is_3D=False):
 
 def read_groundtruths(ground_truth_path, key, is_3D=False):
     """Load an HDF5 data set containing ground truths into memory"""
-    imgs = HDF5Reader().load_hdf5(ground_truth_path, key).astype("uint8")
+    imgs = HDF5Reader().load_hdf5(ground_truth_path, key, dtype=np.uint8)
     print("Loading ground truth HDF5: {} with dtype = {}".format(ground_truth_path, imgs.dtype))
 
     # Permute array dimensions for the 3D U-Net model so that the shape becomes: (-1, height, width, slices, channels),
@@ -428,48 +570,24 @@ def group_images(imgs, num_per_row, empty_color=255, show=False, save_path=None)
     :param save_path: full path for the image, None otherwise
     :return: resulting grid image
     """
-    all_rows= []
-    img_height = imgs.shape[1]
-    img_width = imgs.shape[2]
-    img_channels = imgs.shape[3]
-
     num_rows = (imgs.shape[0] // num_per_row) + (1 if imgs.shape[0] % num_per_row else 0)
-    for i in range(num_rows):
-        # Add the first image to the current row
-        row = imgs[i * num_per_row]
-
-        if i == (num_rows-1):
-            # Ensure the last row does not use more images than available in the array
-            remaining = num_rows * num_per_row - len(imgs)
-            rng = range(i * num_per_row + 1, i * num_per_row + num_per_row - remaining)
-        else:
-            rng = range(i * num_per_row + 1, i * num_per_row + num_per_row)
-
-        # Concatenate the remaining images to the current row
-        for k in rng:
-            row = np.concatenate((row, imgs[k]), axis=1)
-
-        if i == (num_rows-1):
-            # For the last row use white images for any empty cells
-            row = np.concatenate((row, np.full((img_height, remaining*img_width, img_channels),
-                                               empty_color,
-                                               dtype=imgs[0].dtype)),
-                                 axis=1)
-
-        all_rows.append(row)
-
-    # Create the grid image by concatenating all rows
-    final_image = all_rows[0]
-    for i in range(1, len(all_rows)):
-        final_image = np.concatenate((final_image, all_rows[i]),axis=0)
-
-    if final_image.dtype == np.float16:
-        final_image = final_image.astype(np.float32)
+
+    # Fill the empty cells of the last row with empty images, then tile all images at once
+    remaining = num_rows * num_per_row - len(imgs)
+    if remaining > 0:
+        imgs = np.concatenate((imgs, np.full((remaining,) + imgs.shape[1:], empty_color, dtype=imgs.dtype)), axis=0)
+
+    final_image = tile_images(imgs, num_per_row)
+
+    # Matplotlib does not support float16, only convert the single channel that is plotted
+    plot_image = final_image[:, :, 0]
+    if plot_image.dtype == np.float16:
+        plot_image = plot_image.astype(np.float32)
 
     # Plot the image
     plt.figure(figsize=(20.48, 15.36))
     plt.axis('off')
-    plt.imshow(final_image[:, :, 0], cmap="gray")
+    plt.imshow(plot_image, cmap="gray")
 
     # Save the plot to a file if desired
     if save_path is not None:
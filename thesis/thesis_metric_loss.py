@@ -6,6 +6,9 @@ https://github.com/keras-team/keras/issues/5335
 
 Focal loss:
 https://arxiv.org/abs/1708.02002
+
+The losses are chains of element-wise ops followed by a reduction, enable XLA in the session config (global_jit_level
+ON_1, see the training notebooks) to fuse each of them into a single kernel without intermediate tensors
 """
 import keras.backend as K
 import tensorflow as tf
@@ -49,14 +52,17 @@ def focal_loss(target, output, gamma=2):
 
 def weighted_pixelwise_crossentropy_loss(class_weights):
     """Weighted loss cross entropy loss, call with a weight array, e.g. [1, 10]"""
+    # Create the weights tensor once, instead of converting the list every time the loss is called
+    weights = K.constant(class_weights, dtype=K.floatx())
+
     def loss(y_true, y_pred):
         epsilon = tf.convert_to_tensor(K.epsilon(), y_pred.dtype.base_dtype)
 
         # Clip very small and very large predictions
         y_pred = tf.clip_by_value(y_pred, epsilon, 1. - epsilon)
 
-        # Return the *weighted* cross entropy
-        return -tf.reduce_sum(tf.multiply(y_true * tf.log(y_pred), class_weights))
+        # Return the *weighted* cross entropy, the weights are broadcast along the last (class) axis
+        return -tf.reduce_sum(y_true * K.log(y_pred) * K.cast(weights, y_pred.dtype.base_dtype))
 
     return loss
 